@@ -1,154 +1,1100 @@
 import os
+import re
+import sys
+import json
+import asyncio
+import time
+import uuid
+import random
+import atexit
+import hashlib
 import logging
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import threading
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Protocol, TypeVar
+import numpy as np
+import orjson
+import tiktoken
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, constr
 import openai
-import requests
+import httpx
 from dotenv import load_dotenv
+from pythonjsonlogger.orjson import OrjsonFormatter
 import uvicorn
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 # Загрузка переменных окружения из файла .env
 load_dotenv()
 
+# Настройка логирования: записи попадают в очередь, а форматирование в JSON и вывод
+# выполняются фоновым потоком, не занимая цикл событий
+log_queue: Queue = Queue(-1)
+log_output = logging.StreamHandler()
+log_output.setFormatter(OrjsonFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+log_listener = QueueListener(log_queue, log_output, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+log_handler = QueueHandler(log_queue)
+log_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[log_handler])
+logger = logging.getLogger(__name__)
+
+# Настройки пула соединений и повторов для Currents API
+NEWS_MAX_RETRIES = 3
+NEWS_BACKOFF_FACTOR = 0.3
+NEWS_RETRY_STATUSES = {502, 503, 504}
+
+# Кэш новостей по нормализованной теме
+NEWS_CACHE_TTL = int(os.getenv("NEWS_CACHE_TTL", 300))
+news_cache: TTLCache = TTLCache(maxsize=1024, ttl=NEWS_CACHE_TTL)
+# Текущие запросы новостей: одновременные промахи по одной теме ждут один запрос
+news_inflight: Dict[str, asyncio.Task] = {}
+
+CURRENTS_API_URL = "https://api.currentsapi.services/v1/latest-news"
+
+# Прогрев соединений, чтобы первый запрос не тратил время на TLS-рукопожатия
+async def warm_up_clients(app: FastAPI) -> None:
+    try:
+        await app.state.http.head(CURRENTS_API_URL)
+        await app.state.openai.models.retrieve(CONTENT_MODEL)
+        logger.info("API connections warmed up")
+    except (httpx.HTTPError, openai.OpenAIError) as e:
+        logger.warning("Failed to warm up API connections: %s", e)
+
+# Проверка API ключей и создание клиентов при запуске приложения; закрытие при остановке
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    currentsapi_key = os.getenv("CURRENTS_API_KEY")
+    if not openai_api_key:
+        logger.error("OPENAI_API_KEY is not set")
+        raise ValueError("OPENAI_API_KEY environment variable must be set")
+    if not currentsapi_key:
+        logger.error("CURRENTS_API_KEY is not set")
+        raise ValueError("CURRENTS_API_KEY environment variable must be set")
+
+    app.state.currentsapi_key = currentsapi_key
+    # HTTP/2 позволяет мультиплексировать одновременные запросы в одном соединении.
+    # Общий пул соединений с OpenAI переиспользуется всеми запросами процесса
+    app.state.openai_http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+    app.state.openai = openai.AsyncOpenAI(
+        api_key=openai_api_key,
+        http_client=app.state.openai_http,
+        max_retries=0
+    )
+    app.state.http = httpx.AsyncClient(
+        timeout=10,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=NEWS_MAX_RETRIES,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        )
+    )
+    await asyncio.gather(warm_up_clients(app), wait_for_encoding())
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        await app.state.openai_http.aclose()
+
 # Инициализация FastAPI приложения
-app = FastAPI(title="Blog Post Generator", description="API for generating blog posts based on recent news")
+app = FastAPI(
+    title="Blog Post Generator",
+    description="API for generating blog posts based on recent news",
+    lifespan=lifespan
+)
+
+# Модели OpenAI: короткие заголовок и мета-описание генерирует более быстрая и дешёвая модель
+TITLE_MODEL = os.getenv("TITLE_MODEL", "gpt-4.1-nano")
+META_MODEL = os.getenv("META_MODEL", "gpt-4.1-nano")
+CONTENT_MODEL = os.getenv("CONTENT_MODEL", "gpt-4o-mini")
+
+# Число воркеров uvicorn; планировщик и кэши у каждого воркера свои, а при нескольких воркерах нужен Redis
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# Настройки планировщика запросов к OpenAI. RPM_LIMIT и TPM_LIMIT - лимиты аккаунта,
+# они делятся поровну между воркерами; MAX_CONCURRENCY задаётся на процесс
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 8))
+RPM_LIMIT = int(os.getenv("RPM_LIMIT", 500))
+TPM_LIMIT = int(os.getenv("TPM_LIMIT", 200000))
+OPENAI_MAX_RETRIES = 5
+
+T = TypeVar("T")
+
+# Ограничитель частоты запросов по схеме token bucket: лимиты RPM и TPM
+# восполняются равномерно в течение минуты
+class RateLimiter:
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        # Создаётся при первом использовании: до Python 3.10 примитивы asyncio привязываются
+        # к циклу событий при создании, а при импорте модуля это ещё не цикл сервера
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.tpm)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (tokens - self._tokens) * 60 / self.tpm
+                ))
+
+# Семафор параллельности, как и блокировка ограничителя, создаётся внутри цикла событий сервера
+openai_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_openai_semaphore() -> asyncio.Semaphore:
+    global openai_semaphore
+    if openai_semaphore is None:
+        openai_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return openai_semaphore
+
+rate_limiter = RateLimiter(max(1, RPM_LIMIT // WORKERS), max(1, TPM_LIMIT // WORKERS))
+
+# Ошибки, после которых запрос к OpenAI повторяется. Повторы выполняет только планировщик,
+# клиент SDK создаётся с max_retries=0
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+# Вызов OpenAI через общий планировщик: ограничение параллельности, лимиты RPM/TPM
+# и повтор при временных ошибках с экспоненциальной задержкой и случайным разбросом.
+# Исчерпанная квота (insufficient_quota) не повторяется.
+# acquire_slot=False, когда вызывающий код сам удерживает семафор (например, на время чтения потока)
+async def call_openai(request: Callable[[], Awaitable[T]], est_tokens: int, acquire_slot: bool = True) -> T:
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        if acquire_slot:
+            await get_openai_semaphore().acquire()
+        try:
+            await rate_limiter.acquire(est_tokens)
+            try:
+                return await request()
+            except RETRYABLE_OPENAI_ERRORS as e:
+                if attempt == OPENAI_MAX_RETRIES or getattr(e, "code", None) == "insufficient_quota":
+                    raise
+                logger.warning("OpenAI request failed (%s), retrying", type(e).__name__)
+        finally:
+            if acquire_slot:
+                get_openai_semaphore().release()
+        delay = min(60, 2 ** attempt) * (1 + random.random())
+        await asyncio.sleep(delay)
+
+# Лимиты токенов: контекст моделей, запас на служебные токены сообщений и бюджет на заголовки новостей
+MODEL_CONTEXT_TOKENS = 128000
+MESSAGE_OVERHEAD_TOKENS = 64
+NEWS_TOKEN_BUDGET = int(os.getenv("NEWS_TOKEN_BUDGET", 400))
+
+# Токенизатор для подсчёта токенов; пока он не загружен или если словарь недоступен,
+# используется оценка ~4 символа на токен
+ENCODING_LOAD_TIMEOUT = float(os.getenv("ENCODING_LOAD_TIMEOUT", 10))
+encoding = None
+encoding_loaded = threading.Event()
+
+def load_encoding():
+    try:
+        try:
+            return tiktoken.encoding_for_model(CONTENT_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning("Failed to load tiktoken encoding, falling back to estimates: %s", e)
+        return None
+
+# При первом использовании tiktoken скачивает словарь без таймаута, поэтому загрузка идёт в фоновом
+# daemon-потоке: запуск приложения ждёт её ограниченное время, а зависшая загрузка не мешает остановке
+def load_encoding_in_background() -> None:
+    global encoding
+    encoding = load_encoding()
+    # Число токенов системных промптов, посчитанное по оценке, уточняется загруженным словарём
+    for prompt in SYSTEM_PROMPTS:
+        prompt.recount()
+    encoding_loaded.set()
+
+async def wait_for_encoding() -> None:
+    if not encoding_loaded.is_set():
+        threading.Thread(target=load_encoding_in_background, name="tiktoken-loader", daemon=True).start()
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, encoding_loaded.wait, ENCODING_LOAD_TIMEOUT):
+        logger.warning("tiktoken encoding is still loading, using token estimates until it is ready")
+
+def count_tokens(text: str) -> int:
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+# Ограничение max_tokens так, чтобы промпт и ответ помещались в контекст модели
+def fit_max_tokens(max_tokens: int, prompt_tokens: int) -> int:
+    return min(max_tokens, MODEL_CONTEXT_TOKENS - prompt_tokens - MESSAGE_OVERHEAD_TOKENS)
+
+# Настройки семантического кэша ответов
+EMBEDDING_MODEL = "text-embedding-3-small"
+CACHE_SIMILARITY_THRESHOLD = float(os.getenv("CACHE_SIMILARITY_THRESHOLD", 0.92))
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", 1024))
+# Redis используется как общее для воркеров хранилище статусов фоновых задач
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Интерфейс хранилища с ограниченным временем жизни записей
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[dict]: ...
+
+    async def set(self, key: str, value: dict, ttl: int) -> None: ...
 
-# Инициализация клиента OpenAI с API-ключом
-openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-currentsapi_key = os.getenv("CURRENTS_API_KEY")
+# Хранилище в памяти процесса с вытеснением по LRU
+class InMemoryBackend:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
 
-# Проверка наличия API ключей
-if not openai_client.api_key:
-    logger.error("OPENAI_API_KEY is not set")
-    raise ValueError("OPENAI_API_KEY environment variable must be set")
-if not currentsapi_key:
-    logger.error("CURRENTS_API_KEY is not set")
-    raise ValueError("CURRENTS_API_KEY environment variable must be set")
+    async def get(self, key: str) -> Optional[dict]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict, ttl: int) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+# Хранилище в Redis, используется при заданном REDIS_URL
+class RedisBackend:
+    def __init__(self, url: str):
+        import redis.asyncio
+
+        self._client = redis.asyncio.Redis.from_url(url)
+
+    async def get(self, key: str) -> Optional[dict]:
+        raw = await self._client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: dict, ttl: int) -> None:
+        await self._client.setex(key, ttl, json.dumps(value))
+
+# Записи кэша для одного набора новостей: матрица нормированных эмбеддингов и соответствующие её строкам ключи,
+# ответы и времена истечения
+class CacheBucket:
+    def __init__(self, key: str, vector: np.ndarray, value: dict, expires_at: float):
+        self.keys = [key]
+        self.values = [value]
+        self.matrix = vector[np.newaxis, :]
+        self.expires = np.array([expires_at])
+
+    def add(self, key: str, vector: np.ndarray, value: dict, expires_at: float) -> None:
+        self.keys.append(key)
+        self.values.append(value)
+        self.matrix = np.vstack([self.matrix, vector])
+        self.expires = np.append(self.expires, expires_at)
+
+    # Оставляет только строки, отмеченные в маске; возвращает ключи удалённых строк
+    def keep(self, mask: np.ndarray) -> List[str]:
+        removed = [key for key, kept in zip(self.keys, mask) if not kept]
+        self.keys = [key for key, kept in zip(self.keys, mask) if kept]
+        self.values = [value for value, kept in zip(self.values, mask) if kept]
+        self.matrix = self.matrix[mask]
+        self.expires = self.expires[mask]
+        return removed
+
+# Семантический кэш в памяти процесса: ищет ранее сгенерированный ответ по близости
+# эмбеддинга темы среди записей, созданных для того же набора новостей
+class LLMCache:
+    def __init__(self, threshold: float, ttl: int, maxsize: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # хэш новостей -> записи; матрицы обновляются при записи и вытеснении, а не при поиске
+        self._buckets: Dict[str, CacheBucket] = {}
+        # ключ -> хэш новостей в порядке последнего использования
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: list) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _keep(self, news_hash: str, mask: np.ndarray) -> None:
+        bucket = self._buckets[news_hash]
+        for key in bucket.keep(mask):
+            self._lru.pop(key, None)
+        if not bucket.keys:
+            del self._buckets[news_hash]
+
+    def lookup(self, embedding: list, news_hash: str) -> Optional[dict]:
+        bucket = self._buckets.get(news_hash)
+        if bucket is not None:
+            expired = bucket.expires < time.monotonic()
+            if expired.any():
+                self._keep(news_hash, ~expired)
+                bucket = self._buckets.get(news_hash)
+
+        if bucket is not None:
+            scores = np.dot(bucket.matrix, self._normalize(embedding))
+            best = int(np.argmax(scores))
+            if scores[best] > self.threshold:
+                self._lru.move_to_end(bucket.keys[best])
+                self.hits += 1
+                return bucket.values[best]
+
+        self.misses += 1
+        return None
+
+    def store(self, embedding: list, news_hash: str, value: dict) -> None:
+        key = f"llmcache:{news_hash}:{uuid.uuid4().hex}"
+        vector = self._normalize(embedding)
+        expires_at = time.monotonic() + self.ttl
+        bucket = self._buckets.get(news_hash)
+        if bucket is None:
+            self._buckets[news_hash] = CacheBucket(key, vector, value, expires_at)
+        else:
+            bucket.add(key, vector, value, expires_at)
+        self._lru[key] = news_hash
+
+        while len(self._lru) > self.maxsize:
+            evicted, evicted_hash = self._lru.popitem(last=False)
+            evicted_bucket = self._buckets[evicted_hash]
+            self._keep(evicted_hash, np.array([k != evicted for k in evicted_bucket.keys]))
+
+llm_cache = LLMCache(
+    threshold=CACHE_SIMILARITY_THRESHOLD,
+    ttl=CACHE_TTL,
+    maxsize=CACHE_MAXSIZE,
+)
 
 # Модель данных для входящего запроса
 class Topic(BaseModel):
-    topic: str
+    topic: constr(strip_whitespace=True, min_length=2, max_length=200)
+
+# Шаблоны для отсева тем, на которые не стоит тратить запросы к OpenAI
+URL_PATTERN = re.compile(r"https?://|www\.", re.IGNORECASE)
+# Инструкции модели распознаются только в повелительной форме, чтобы темы вроде
+# "System prompt leaks" оставались допустимыми
+PROMPT_INJECTION_PATTERN = re.compile(
+    r"\b(ignore|disregard|forget)\s+(all\s+|any\s+)?(the\s+|your\s+)?(previous|prior|above|earlier)\s+"
+    r"(instructions|prompts?|rules)\b"
+    r"|\b(ignore|disregard|forget)\s+(all\s+)?your\s+(instructions|prompts?|rules)\b"
+    r"|\b(reveal|show|print|repeat|output)\s+(me\s+)?your\s+(system\s+prompt|instructions|rules)\b",
+    re.IGNORECASE
+)
+# Только целые слова, без суффиксов: иначе под фильтр попадают обычные слова ("Shitake")
+PROFANITY_PATTERN = re.compile(
+    r"\b(fuck|fucking|fucked|fucker|motherfucker|shit|shitty|bitch|bitches|cunt|asshole)\b",
+    re.IGNORECASE
+)
 
-# Функция для получения последних новостей
-def get_recent_news(topic: str) -> str:
-    logger.info(f"Fetching news for topic: {topic}")
-    url = "https://api.currentsapi.services/v1/latest-news"
+# Функция для проверки темы до обращения к внешним API
+def check_topic(topic: str) -> None:
+    if not re.search(r"[^\W_]", topic):
+        logger.warning("Rejected topic without letters or digits: %s", topic)
+        raise HTTPException(status_code=400, detail="Topic must contain letters or digits")
+    if URL_PATTERN.search(topic):
+        logger.warning("Rejected topic with a link: %s", topic)
+        raise HTTPException(status_code=400, detail="Topic must not contain links")
+    if PROMPT_INJECTION_PATTERN.search(topic):
+        logger.warning("Rejected topic with instructions: %s", topic)
+        raise HTTPException(status_code=400, detail="Topic must not contain instructions")
+    if PROFANITY_PATTERN.search(topic):
+        logger.warning("Rejected topic with profanity: %s", topic)
+        raise HTTPException(status_code=400, detail="Topic must not contain profanity")
+
+# Структурированный ответ модели с заголовком и мета-описанием
+class Headline(BaseModel):
+    title: str
+    meta_description: str
+
+# Структурированный ответ модели с готовым постом
+class Article(BaseModel):
+    title: str
+    meta_description: str
+    post_content: str
+
+# Объединение одновременных одинаковых операций: первый вызов запускает задачу, остальные ждут её результат.
+# Задача защищена от отмены, чтобы отключение одного клиента не прерывало работу для остальных
+async def coalesce(inflight: Dict[str, asyncio.Task], key: str, factory: Callable[[], Awaitable[T]]) -> T:
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        inflight[key] = task
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+# Функция для получения последних новостей с кэшированием и объединением одновременных запросов
+async def get_recent_news(topic: str) -> str:
+    key = topic.strip().lower()
+    news = news_cache.get(key)
+    if news is not None:
+        logger.info("News cache hit for topic: %s", topic)
+        return news
+
+    news = await coalesce(news_inflight, key, lambda: fetch_recent_news(topic))
+    news_cache[key] = news
+    return news
+
+# Функция для запроса последних новостей из Currents API
+async def fetch_recent_news(topic: str) -> str:
+    logger.info("Fetching news for topic: %s", topic)
     params = {
         "language": "en",
         "keywords": topic,
-        "apiKey": currentsapi_key
+        "apiKey": app.state.currentsapi_key
     }
     
     try:
-        response = requests.get(url, params=params, timeout=10)
+        # Повтор с экспоненциальной задержкой при временных ошибках шлюза
+        for attempt in range(NEWS_MAX_RETRIES + 1):
+            response = await app.state.http.get(CURRENTS_API_URL, params=params)
+            if response.status_code not in NEWS_RETRY_STATUSES or attempt == NEWS_MAX_RETRIES:
+                break
+            logger.warning("Currents API returned %s, retrying", response.status_code)
+            await asyncio.sleep(NEWS_BACKOFF_FACTOR * 2 ** attempt)
+        logger.debug("Currents API responded over %s", response.http_version)
         if response.status_code != 200:
-            logger.error(f"Currents API error: {response.status_code} - {response.text}")
+            logger.error("Currents API error: %s - %s", response.status_code, response.text)
             raise HTTPException(status_code=500, detail=f"Currents API error: {response.text}")
         
-        news_data = response.json().get("news", [])
+        # Ответ содержит полные тексты статей, поэтому байты разбираются напрямую через orjson
+        news_data = orjson.loads(response.content).get("news", [])
         if not news_data:
-            logger.warning(f"No news found for topic: {topic}")
+            logger.warning("No news found for topic: %s", topic)
             return "No recent news found."
         
         news_titles = [article["title"] for article in news_data[:5]]
-        logger.info(f"Found {len(news_titles)} news articles for topic: {topic}")
+        # Отбрасываем последние заголовки, пока новости не уложатся в бюджет токенов
+        while len(news_titles) > 1 and count_tokens("\n".join(news_titles)) > NEWS_TOKEN_BUDGET:
+            news_titles.pop()
+        logger.info("Found %s news articles for topic: %s", len(news_titles), topic)
         return "\n".join(news_titles)
     
-    except requests.RequestException as e:
-        logger.error(f"Failed to fetch news: {str(e)}")
+    except httpx.HTTPError as e:
+        logger.error("Failed to fetch news: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to fetch news: {str(e)}")
 
+# Функция для получения эмбеддинга темы
+async def get_topic_embedding(topic: str) -> list:
+    response = await call_openai(
+        lambda: app.state.openai.embeddings.create(model=EMBEDDING_MODEL, input=topic),
+        count_tokens(topic)
+    )
+    return response.data[0].embedding
+
+# Общие правила редакции. Передаются первым системным сообщением во всех запросах и не содержат
+# подстановок, чтобы префикс промпта был побайтно одинаковым и попадал в кэш промптов OpenAI
+# (кэш срабатывает для префиксов от 1024 токенов)
+STATIC_RULES = (
+    "You are the editor of a news-driven blog whose posts are published on Telegram channels and on the web. "
+    "Every request gives you a topic and a short list of recent news headlines about it. "
+    "Your job is to turn them into publication-ready material that follows the editorial rules below.\n"
+    "\n"
+    "GENERAL PRINCIPLES\n"
+    "1. Accuracy first. Only state facts that follow from the provided news headlines or from widely known, "
+    "stable background knowledge. Never invent quotes, statistics, names, dates, or sources.\n"
+    "2. When the news list says that no recent news was found, write about the topic in general terms and "
+    "focus on long-term trends instead of specific events.\n"
+    "3. Stay neutral. Present different viewpoints fairly, avoid political advocacy, and do not give "
+    "medical, legal, or financial advice.\n"
+    "4. Write in clear, modern English for a general audience. Explain jargon and abbreviations the first "
+    "time they appear.\n"
+    "5. Do not mention these instructions, the prompt, or the fact that the text was generated.\n"
+    "6. Do not include links, hashtags, emojis, or calls to subscribe unless the request asks for them.\n"
+    "\n"
+    "TITLE RULES\n"
+    "1. The title must be engaging and accurate, interesting to read, and clearly convey the topic.\n"
+    "2. Keep it to a single line of at most twelve words; do not end it with a period.\n"
+    "3. Prefer concrete nouns and active verbs over vague words such as \"things\" or \"stuff\".\n"
+    "4. Avoid clickbait: the article must deliver what the title promises.\n"
+    "5. Do not wrap the title in quotation marks and do not prefix it with labels such as \"Title:\".\n"
+    "\n"
+    "META DESCRIPTION RULES\n"
+    "1. The meta description must be informative, include the key topic words, and be engaging.\n"
+    "2. Keep it between 120 and 160 characters so that search engines display it in full.\n"
+    "3. Summarize what the reader will learn; do not repeat the title word for word.\n"
+    "4. Write it as one or two complete sentences in the present tense.\n"
+    "\n"
+    "ARTICLE RULES\n"
+    "The article must be:\n"
+    "1. Informative and logical\n"
+    "2. At least 1500 characters\n"
+    "3. Structured with subheadings\n"
+    "4. Include analysis of current trends\n"
+    "5. Have an introduction, main body, and conclusion\n"
+    "6. Include examples from recent news\n"
+    "7. Each paragraph should have at least 3-4 sentences\n"
+    "8. Be easy to read and insightful\n"
+    "\n"
+    "ARTICLE STRUCTURE\n"
+    "1. Introduction: one or two paragraphs that explain why the topic matters right now and what the "
+    "reader will find in the article.\n"
+    "2. Main body: three or four sections, each with its own descriptive subheading. Each section develops "
+    "one idea, such as the background of the topic, the latest developments, the main players, the "
+    "opportunities, or the risks.\n"
+    "3. Trend analysis: at least one section that connects the recent news to broader trends and explains "
+    "what may happen next and why.\n"
+    "4. Conclusion: a short summary of the key points and a forward-looking final thought. Do not "
+    "introduce new facts in the conclusion.\n"
+    "\n"
+    "STYLE GUIDE\n"
+    "1. Use Markdown subheadings that start with \"## \" for sections; do not use a top-level heading, "
+    "because the title is published separately.\n"
+    "2. Keep sentences reasonably short and vary their length. Avoid long chains of subordinate clauses.\n"
+    "3. Use paragraphs rather than bullet lists for the main argument; short lists are acceptable for "
+    "enumerations of three or more parallel items.\n"
+    "4. Refer to news events by describing them, for example \"a recent report on ...\", rather than "
+    "pasting the headline verbatim.\n"
+    "5. Use numbers and dates only when they come from the provided news; round them sensibly and give "
+    "context for what they mean.\n"
+    "6. Avoid filler phrases such as \"in today's fast-paced world\", \"it is worth noting that\", or "
+    "\"in conclusion, it can be said\".\n"
+    "7. Avoid repeating the same sentence openings and the same key phrase in consecutive paragraphs.\n"
+    "8. Keep a confident but measured tone: distinguish clearly between established facts, reported "
+    "claims, and your own analysis.\n"
+    "\n"
+    "WORKING WITH THE NEWS\n"
+    "1. Treat the headlines as signals of what is happening now, not as complete reports. Do not claim to "
+    "know details that a headline does not contain.\n"
+    "2. Group related headlines together and explain what they have in common before discussing them one "
+    "by one.\n"
+    "3. If a headline is unrelated to the topic, ignore it instead of forcing a connection.\n"
+    "4. If headlines contradict each other, say so and explain which interpretation seems more plausible "
+    "and why.\n"
+    "5. Prefer the most recent and most specific developments when choosing examples for the article.\n"
+    "\n"
+    "AUDIENCE AND FORMAT\n"
+    "1. Readers usually see the post in a messenger on a phone screen, so keep paragraphs compact and put "
+    "the most important information early in each section.\n"
+    "2. Assume the reader is curious and intelligent but not a specialist in the field.\n"
+    "3. Keep the whole article between 1500 and 3500 characters so that it remains comfortable to read in "
+    "one sitting; prefer fewer, denser sections over many short ones.\n"
+    "4. Use plain Markdown only: subheadings, bold text for rare emphasis, and simple lists. Do not use "
+    "tables, code blocks, or HTML.\n"
+    "\n"
+    "QUALITY CHECKLIST\n"
+    "Before answering, silently check that the text is factually consistent with the news, that every "
+    "section has a subheading, that every paragraph has at least three sentences, that the article is "
+    "longer than 1500 characters, and that the title, meta description, and article agree with each other."
+)
+
+# Шаблоны изменяемой части промпта, подготовленные один раз при загрузке модуля
+format_topic_news = "Topic: {topic}\nRecent news:\n{recent_news}".format
+format_title = "Title: {title}".format
+
+# Неизменяемые системные сообщения каждого вида запроса: общие правила и постоянная инструкция
+RULES_MESSAGE = {"role": "system", "content": STATIC_RULES}
+
+# Системные сообщения с заранее посчитанным числом токенов, чтобы не токенизировать их в каждом запросе
+class SystemPrompt:
+    def __init__(self, instruction: str):
+        self.messages = (RULES_MESSAGE, {"role": "system", "content": instruction})
+        self.recount()
+
+    def recount(self) -> None:
+        self.tokens = sum(count_tokens(message["content"]) for message in self.messages)
+
+TITLE_PROMPT = SystemPrompt(
+    "Create a title for an article on the topic below, considering the recent news. "
+    "Reply with the title only."
+)
+META_PROMPT = SystemPrompt(
+    "Write a meta description for an article with the title below. "
+    "Reply with the meta description only."
+)
+CONTENT_PROMPT = SystemPrompt(
+    "Write a detailed article on the topic below using the recent news. "
+    "Reply with the article only."
+)
+ARTICLE_PROMPT = SystemPrompt(
+    "Return JSON with title, meta_description and post_content for an article "
+    "on the topic below, using the recent news."
+)
+HEADLINE_PROMPT = SystemPrompt(
+    "Return JSON with title and meta_description for an article "
+    "on the topic below, using the recent news."
+)
+SYSTEM_PROMPTS = (TITLE_PROMPT, META_PROMPT, CONTENT_PROMPT, ARTICLE_PROMPT, HEADLINE_PROMPT)
+
+# Неизменяемые параметры запросов, подготовленные один раз при загрузке модуля
+TITLE_PARAMS = dict(
+    model=TITLE_MODEL,
+    max_tokens=40,
+    temperature=0.5,
+    stop=["\n"]
+)
+META_PARAMS = dict(
+    model=META_MODEL,
+    max_tokens=120,
+    temperature=0.5
+)
+CONTENT_PARAMS = dict(
+    model=CONTENT_MODEL,
+    max_tokens=1000,  # Уменьшено для скорости
+    temperature=0.5,
+    presence_penalty=0.6,
+    frequency_penalty=0.6
+)
+ARTICLE_PARAMS = dict(
+    model=CONTENT_MODEL,
+    response_format=Article,
+    max_tokens=1200,
+    temperature=0.5,
+    presence_penalty=0.6,
+    frequency_penalty=0.6
+)
+HEADLINE_PARAMS = dict(
+    model=TITLE_MODEL,
+    response_format=Headline,
+    max_tokens=160,
+    temperature=0.5
+)
+
+# Готовый запрос: параметры для API и число токенов для лимита TPM (промпт плюс лимит ответа)
+class PreparedRequest(NamedTuple):
+    params: dict
+    tokens: int
+
+# Функция для сборки запроса: к готовым системным сообщениям добавляется только изменяемое сообщение
+# пользователя, и токенизируется только оно; число токенов промпта считается один раз
+def build_request(params: dict, system: SystemPrompt, user_content: str) -> PreparedRequest:
+    prompt_tokens = system.tokens + count_tokens(user_content)
+    max_tokens = fit_max_tokens(params["max_tokens"], prompt_tokens)
+    return PreparedRequest(
+        dict(
+            params,
+            messages=[*system.messages, {"role": "user", "content": user_content}],
+            max_tokens=max_tokens
+        ),
+        prompt_tokens + max_tokens
+    )
+
+# Параметры запроса на генерацию заголовка
+def title_request(topic: str, recent_news: str) -> PreparedRequest:
+    return build_request(TITLE_PARAMS, TITLE_PROMPT, format_topic_news(topic=topic, recent_news=recent_news))
+
+# Параметры запроса на генерацию мета-описания
+def meta_request(title: str) -> PreparedRequest:
+    return build_request(META_PARAMS, META_PROMPT, format_title(title=title))
+
+# Параметры запроса на генерацию статьи
+def content_request(topic: str, recent_news: str) -> PreparedRequest:
+    return build_request(CONTENT_PARAMS, CONTENT_PROMPT, format_topic_news(topic=topic, recent_news=recent_news))
+
+# Параметры единого запроса на генерацию заголовка, мета-описания и статьи
+def article_request(topic: str, recent_news: str) -> PreparedRequest:
+    return build_request(ARTICLE_PARAMS, ARTICLE_PROMPT, format_topic_news(topic=topic, recent_news=recent_news))
+
+# Параметры запроса на генерацию заголовка и мета-описания для потоковой выдачи
+def headline_request(topic: str, recent_news: str) -> PreparedRequest:
+    return build_request(HEADLINE_PARAMS, HEADLINE_PROMPT, format_topic_news(topic=topic, recent_news=recent_news))
+
+# Функция для получения новостей, эмбеддинга темы и ответа из семантического кэша
+async def prepare_generation(topic: str) -> tuple:
+    # Новости и эмбеддинг темы не зависят друг от друга
+    recent_news, embedding = await asyncio.gather(
+        get_recent_news(topic),
+        get_topic_embedding(topic)
+    )
+    news_hash = hashlib.sha256(recent_news.encode()).hexdigest()
+
+    # Поиск близкой темы в семантическом кэше
+    cached = llm_cache.lookup(embedding, news_hash)
+    if cached is not None:
+        logger.info("Semantic cache hit for topic: %s", topic)
+    return recent_news, embedding, news_hash, cached
+
+# Текущие генерации: одновременные запросы на одну тему получают результат одной генерации
+generation_inflight: Dict[str, asyncio.Task] = {}
+
+# Функция для генерации контента с объединением одновременных запросов на одну тему
+async def generate_content(topic: str) -> dict:
+    key = hashlib.sha256(topic.lower().encode()).hexdigest()
+    if key in generation_inflight:
+        logger.info("Joining in-flight generation for topic: %s", topic)
+    return await coalesce(generation_inflight, key, lambda: run_generation(topic))
+
 # Функция для генерации контента
-def generate_content(topic: str) -> dict:
-    logger.info(f"Generating content for topic: {topic}")
-    recent_news = get_recent_news(topic)
+async def run_generation(topic: str) -> dict:
+    logger.info("Generating content for topic: %s", topic)
     
     try:
-        # Генерация заголовка
-        title_response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "user",
-                "content": f"Create an engaging and accurate title for an article on '{topic}', "
-                          f"considering recent news:\n{recent_news}. "
-                          "The title should be interesting and clearly convey the topic."
-            }],
-            max_tokens=40,
-            temperature=0.5,
-            stop=["\n"]
+        recent_news, embedding, news_hash, cached = await prepare_generation(topic)
+        if cached is not None:
+            return cached
+
+        # Заголовок, мета-описание и статья генерируются одним запросом со структурированным ответом
+        request = article_request(topic, recent_news)
+        response = await call_openai(
+            lambda: app.state.openai.chat.completions.parse(**request.params),
+            request.tokens
         )
-        title = title_response.choices[0].message.content.strip()
+        article = response.choices[0].message.parsed
+        if article is None:
+            logger.error("Structured response was not parsed")
+            raise HTTPException(status_code=500, detail="Failed to generate article: unparsable response")
+
+        title = article.title.strip()
         if not title:
             logger.error("Empty title generated")
             raise HTTPException(status_code=500, detail="Failed to generate title: empty response")
-        logger.info(f"Generated title: {title}")
-
-        # Генерация мета-описания
-        meta_response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "user",
-                "content": f"Write a meta description for an article titled '{title}'. "
-                          "It should be informative, include key topic words, and be engaging."
-            }],
-            max_tokens=120,
-            temperature=0.5,
-            stop=["."]
-        )
-        meta_description = meta_response.choices[0].message.content.strip()
+        logger.info("Generated title: %s", title)
+
+        meta_description = article.meta_description.strip()
         if not meta_description:
             logger.error("Empty meta description generated")
             raise HTTPException(status_code=500, detail="Failed to generate meta description: empty response")
-        logger.info(f"Generated meta description: {meta_description}")
-
-        # Генерация контента
-        content_response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "user",
-                "content": f"Write a detailed article on '{topic}' using recent news:\n{recent_news}. "
-                          "The article must be:\n"
-                          "1. Informative and logical\n"
-                          "2. At least 1500 characters\n"
-                          "3. Structured with subheadings\n"
-                          "4. Include analysis of current trends\n"
-                          "5. Have an introduction, main body, and conclusion\n"
-                          "6. Include examples from recent news\n"
-                          "7. Each paragraph should have at least 3-4 sentences\n"
-                          "8. Be easy to read and insightful"
-            }],
-            max_tokens=1000,  # Уменьшено для скорости
-            temperature=0.5,
-            presence_penalty=0.6,
-            frequency_penalty=0.6
-        )
-        post_content = content_response.choices[0].message.content.strip()
+        logger.info("Generated meta description: %s", meta_description)
+
+        post_content = article.post_content.strip()
         if not post_content or len(post_content) < 1500:
-            logger.error(f"Generated content too short: {len(post_content)} characters")
+            logger.error("Generated content too short: %s characters", len(post_content))
             raise HTTPException(status_code=500, detail="Generated content is too short or empty")
-        logger.info(f"Generated article with {len(post_content)} characters")
+        logger.info("Generated article with %s characters", len(post_content))
 
-        return {
+        result = {
             "title": title,
             "meta_description": meta_description,
             "post_content": post_content
         }
+        llm_cache.store(embedding, news_hash, result)
+        return result
     
+    except HTTPException:
+        raise
     except openai.OpenAIError as e:
-        logger.error(f"OpenAI API error: {str(e)}")
+        logger.error("OpenAI API error: %s", e)
         raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
     except Exception as e:
-        logger.error(f"Unexpected error during content generation: {str(e)}")
+        logger.error("Unexpected error during content generation: %s", e)
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+# Функция для формирования события Server-Sent Events
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+# Потоковая выдача поста из кэша
+async def stream_cached_post(post: dict) -> AsyncIterator[str]:
+    yield sse_event({"title": post["title"]}, "title")
+    yield sse_event({"meta_description": post["meta_description"]}, "meta")
+    yield sse_event({"delta": post["post_content"]})
+    yield sse_event({}, "done")
+
+# Потоковая генерация поста: заголовок и мета-описание отправляются целиком,
+# статья передаётся по частям по мере генерации
+async def stream_generated_post(topic: str, recent_news: str, embedding: list, news_hash: str) -> AsyncIterator[str]:
+    try:
+        request = headline_request(topic, recent_news)
+        response = await call_openai(
+            lambda: app.state.openai.chat.completions.parse(**request.params),
+            request.tokens
+        )
+        headline = response.choices[0].message.parsed
+        title = headline.title.strip() if headline else ""
+        meta_description = headline.meta_description.strip() if headline else ""
+        if not title or not meta_description:
+            logger.error("Empty title or meta description generated")
+            yield sse_event({"detail": "Failed to generate title or meta description: empty response"}, "error")
+            return
+        logger.info("Generated title: %s", title)
+        yield sse_event({"title": title}, "title")
+        yield sse_event({"meta_description": meta_description}, "meta")
+
+        request = content_request(topic, recent_news)
+        # Семафор удерживается до конца чтения потока, чтобы MAX_CONCURRENCY учитывал и долгие генерации
+        async with get_openai_semaphore():
+            stream = await call_openai(
+                lambda: app.state.openai.chat.completions.create(**request.params, stream=True),
+                request.tokens,
+                acquire_slot=False
+            )
+            # Текст накапливается для проверки длины и записи в кэш. Поток закрывается и при отключении
+            # клиента, чтобы OpenAI прекратил генерацию
+            parts = []
+            async with stream:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        delta = chunk.choices[0].delta.content
+                        parts.append(delta)
+                        yield sse_event({"delta": delta})
+
+        post_content = "".join(parts).strip()
+        if len(post_content) < 1500:
+            logger.error("Generated content too short: %s characters", len(post_content))
+            yield sse_event({"detail": "Generated content is too short or empty"}, "error")
+            return
+        logger.info("Streamed article with %s characters", len(post_content))
+
+        llm_cache.store(embedding, news_hash, {
+            "title": title,
+            "meta_description": meta_description,
+            "post_content": post_content
+        })
+        yield sse_event({}, "done")
+
+    except openai.OpenAIError as e:
+        logger.error("OpenAI API error: %s", e)
+        yield sse_event({"detail": f"OpenAI API error: {str(e)}"}, "error")
+    # Ошибки соединения при чтении потока SDK не оборачивает в OpenAIError
+    except httpx.HTTPError as e:
+        logger.error("OpenAI stream error: %s", e)
+        yield sse_event({"detail": f"OpenAI stream error: {str(e)}"}, "error")
+
+# Функция для потоковой генерации поста в формате Server-Sent Events
+async def stream_content(topic: str) -> StreamingResponse:
+    logger.info("Streaming content for topic: %s", topic)
+    try:
+        recent_news, embedding, news_hash, cached = await prepare_generation(topic)
+    except openai.OpenAIError as e:
+        logger.error("OpenAI API error: %s", e)
+        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+
+    if cached is not None:
+        events = stream_cached_post(cached)
+    else:
+        events = stream_generated_post(topic, recent_news, embedding, news_hash)
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Фоновые задачи генерации: статус и результат хранятся ограниченное время.
+# С REDIS_URL статус доступен всем воркерам, иначе только процессу, принявшему задачу,
+# поэтому несколько воркеров запускаются только с Redis
+JOB_TTL = int(os.getenv("JOB_TTL", 3600))
+job_store: CacheBackend = RedisBackend(REDIS_URL) if REDIS_URL else InMemoryBackend(10000)
+# Ссылки на выполняющиеся задачи, чтобы их не удалил сборщик мусора; по ним же определяется
+# статус незавершённых задач, поэтому вытеснение из хранилища в памяти их не теряет
+job_tasks: Dict[str, asyncio.Task] = {}
+
+# Функция для выполнения генерации в фоне с сохранением результата
+async def run_job(job_id: str, topic: str) -> None:
+    try:
+        result = await generate_content(topic)
+    except HTTPException as e:
+        job = {"status": "error", "detail": e.detail}
+    except Exception as e:
+        logger.error("Unexpected error in generation job %s: %s", job_id, e)
+        job = {"status": "error", "detail": f"Unexpected error: {str(e)}"}
+    else:
+        job = {"status": "done", "result": result}
+    await job_store.set(f"job:{job_id}", job, JOB_TTL)
+
+# Функция для запуска фоновой генерации
+async def start_job(topic: str) -> str:
+    job_id = uuid.uuid4().hex
+    await job_store.set(f"job:{job_id}", {"status": "pending"}, JOB_TTL)
+    task = asyncio.create_task(run_job(job_id, topic))
+    job_tasks[job_id] = task
+    task.add_done_callback(lambda _: job_tasks.pop(job_id, None))
+    logger.info("Started generation job %s for topic: %s", job_id, topic)
+    return job_id
+
+# Функция для получения статуса фоновой генерации
+async def get_job(job_id: str) -> dict:
+    task = job_tasks.get(job_id)
+    if task is not None and not task.done():
+        return {"job_id": job_id, "status": "pending"}
+    job = await job_store.get(f"job:{job_id}")
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return {"job_id": job_id, **job}
+
 @app.post("/generate-post", summary="Generate a blog post based on a topic")
-async def generate_post_api(topic: Topic):
-    logger.info(f"Received request to generate post for topic: {topic.topic}")
-    return generate_content(topic.topic)
+async def generate_post_api(topic: Topic, request: Request):
+    logger.info("Received request to generate post for topic: %s", topic.topic)
+    check_topic(topic.topic)
+    # Клиенты, запросившие text/event-stream, получают пост потоком событий
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return await stream_content(topic.topic)
+    # Клиенты с заголовком "Prefer: respond-async" сразу получают идентификатор задачи
+    if "respond-async" in request.headers.get("prefer", ""):
+        job_id = await start_job(topic.topic)
+        return JSONResponse(
+            {"job_id": job_id},
+            status_code=202,
+            headers={"Location": f"/generate-post/{job_id}", "Preference-Applied": "respond-async"}
+        )
+    return await generate_content(topic.topic)
+
+@app.get("/generate-post/{job_id}", summary="Get the status and result of a background generation")
+async def generate_post_job_api(job_id: str):
+    return await get_job(job_id)
+
+@app.websocket("/ws/generate-post/{job_id}")
+async def generate_post_job_ws(websocket: WebSocket, job_id: str):
+    await websocket.accept()
+    # Ожидание завершения задачи и отправка итогового статуса
+    task = job_tasks.get(job_id)
+    if task is not None:
+        await asyncio.wait({task})
+    try:
+        job = await get_job(job_id)
+        # Задачу выполняет другой воркер: опрос общего хранилища
+        while job["status"] == "pending":
+            await asyncio.sleep(1)
+            job = await get_job(job_id)
+        await websocket.send_json(job)
+    except HTTPException as e:
+        await websocket.send_json({"job_id": job_id, "status": "error", "detail": e.detail})
+    await websocket.close()
+
+# Ограничения пакетного режима: число тем в одном задании и одновременных запросов новостей
+# (меньше пула соединений с Currents API, чтобы запросы не ждали свободного соединения дольше таймаута)
+BATCH_MAX_TOPICS = int(os.getenv("BATCH_MAX_TOPICS", 100))
+BATCH_NEWS_CONCURRENCY = 10
+
+# Части поста, которые генерируются отдельными строками пакетного задания
+BATCH_PARTS = {
+    "title": "title",
+    "meta": "meta_description",
+    "content": "post_content"
+}
+
+# Функция для отправки пакетного задания в OpenAI Batch API
+async def submit_batch(topics: List[str]) -> str:
+    logger.info("Submitting batch for %s topics", len(topics))
+    news_semaphore = asyncio.Semaphore(BATCH_NEWS_CONCURRENCY)
+
+    async def get_news(topic: str) -> str:
+        async with news_semaphore:
+            return await get_recent_news(topic)
+
+    news = await asyncio.gather(*(get_news(topic) for topic in topics))
+
+    # В пакетном режиме заголовок ещё неизвестен, поэтому мета-описание строится по теме
+    lines = []
+    for topic_id, (topic, recent_news) in enumerate(zip(topics, news)):
+        requests_by_part = {
+            "title": title_request(topic, recent_news).params,
+            "meta": meta_request(topic).params,
+            "content": content_request(topic, recent_news).params
+        }
+        for part, body in requests_by_part.items():
+            lines.append(json.dumps({
+                "custom_id": f"{topic_id}:{part}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
+
+    try:
+        batch_file = await app.state.openai.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        batch = await app.state.openai.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except openai.OpenAIError as e:
+        logger.error("OpenAI API error: %s", e)
+        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+
+    logger.info("Submitted batch %s", batch.id)
+    return batch.id
+
+# Функция для чтения файла результатов пакетного задания
+async def read_batch_file(file_id: Optional[str]) -> List[dict]:
+    if not file_id:
+        return []
+    content = await app.state.openai.files.content(file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+# Функция для получения результатов пакетного задания
+async def collect_batch(batch_id: str) -> dict:
+    try:
+        batch = await app.state.openai.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return {"batch_id": batch_id, "status": batch.status}
+
+        # Успешные строки попадают в файл результатов, а неудачные - в файл ошибок
+        records = await read_batch_file(batch.output_file_id) + await read_batch_file(batch.error_file_id)
+    except openai.NotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    except openai.OpenAIError as e:
+        logger.error("OpenAI API error: %s", e)
+        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+
+    # Каждая тема отправляется несколькими строками, поэтому число тем известно из общего числа запросов
+    topic_count = (batch.request_counts.total if batch.request_counts else 0) // len(BATCH_PARTS)
+    posts: Dict[int, dict] = {topic_id: {"topic_id": topic_id} for topic_id in range(topic_count)}
+
+    # Сборка частей поста по custom_id вида "<topic_id>:<part>"
+    for record in records:
+        topic_id, part = record["custom_id"].split(":", 1)
+        post = posts.setdefault(int(topic_id), {"topic_id": int(topic_id)})
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            post[BATCH_PARTS[part]] = response["body"]["choices"][0]["message"]["content"].strip()
+        else:
+            post["error"] = record.get("error") or response.get("body")
+
+    # Пост без одной из частей или со слишком короткой статьёй считается неудавшимся
+    for post in posts.values():
+        if "error" in post:
+            continue
+        missing = [field for field in BATCH_PARTS.values() if not post.get(field)]
+        if missing:
+            post["error"] = f"Missing {', '.join(missing)} in batch results"
+        elif len(post["post_content"]) < 1500:
+            logger.error("Generated content too short: %s characters", len(post["post_content"]))
+            del post["post_content"]
+            post["error"] = "Generated content is too short or empty"
+
+    logger.info("Collected %s posts from batch %s", len(posts), batch_id)
+    return {
+        "batch_id": batch_id,
+        "status": batch.status,
+        "results": [posts[topic_id] for topic_id in sorted(posts)]
+    }
+
+@app.post("/generate-post-batch", summary="Submit topics for deferred generation via the OpenAI Batch API")
+async def generate_post_batch_api(topics: List[Topic]):
+    logger.info("Received batch request for %s topics", len(topics))
+    if not topics:
+        raise HTTPException(status_code=400, detail="At least one topic is required")
+    if len(topics) > BATCH_MAX_TOPICS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_TOPICS} topics are allowed per batch")
+    for topic in topics:
+        check_topic(topic.topic)
+    batch_id = await submit_batch([topic.topic for topic in topics])
+    return {"batch_id": batch_id}
+
+@app.get("/batch/{batch_id}", summary="Get the status and results of a batch generation")
+async def batch_status_api(batch_id: str):
+    logger.info("Batch status requested: %s", batch_id)
+    return await collect_batch(batch_id)
 
 @app.get("/", summary="Check if the service is running")
 async def root():
@@ -160,7 +1106,43 @@ async def heartbeat_api():
     logger.info("Heartbeat endpoint accessed")
     return {"status": "OK"}
 
+@app.get("/metrics", summary="Semantic cache statistics")
+async def metrics_api():
+    return {"cache_hits": llm_cache.hits, "cache_misses": llm_cache.misses}
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    logger.info(f"Starting server on port {port}")
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
+    max_open_files = 65536
+
+    # Без общего хранилища статус фоновой задачи знает только принявший её воркер
+    if WORKERS > 1 and not REDIS_URL:
+        logger.error("REDIS_URL is not set")
+        raise ValueError("REDIS_URL environment variable must be set when WORKERS > 1")
+
+    # Поднятие лимита открытых файлов, чтобы выдерживать много соединений.
+    # Жёсткий лимит может быть бесконечным (macOS), поэтому целевое значение ограничено
+    if sys.platform != "win32":
+        import resource
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = max_open_files if hard == resource.RLIM_INFINITY else min(hard, max_open_files)
+        if soft != resource.RLIM_INFINITY and soft < target:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            except (ValueError, OSError) as e:
+                logger.warning("Failed to raise the open file limit to %s: %s", target, e)
+
+    logger.info("Starting server on port %s with %s workers", port, WORKERS)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        workers=WORKERS,
+        backlog=2048,
+        reload=False,
+        # Без собственной конфигурации логов uvicorn его логгеры, включая журнал доступа,
+        # передают записи в общий обработчик с очередью и выводятся в JSON
+        log_config=None
+    )
@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+
+from app import LLMCache
+
+POST_A = {"title": "A"}
+POST_B = {"title": "B"}
+POST_C = {"title": "C"}
+
+
+class LLMCacheTest(unittest.TestCase):
+    def make_cache(self, maxsize: int = 10) -> LLMCache:
+        return LLMCache(threshold=0.9, ttl=60, maxsize=maxsize)
+
+    def test_hit_above_threshold(self):
+        cache = self.make_cache()
+        cache.store([1.0, 0.0, 0.0], "news", POST_A)
+        self.assertEqual(cache.lookup([0.99, 0.05, 0.0], "news"), POST_A)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_miss_below_threshold(self):
+        cache = self.make_cache()
+        cache.store([1.0, 0.0, 0.0], "news", POST_A)
+        self.assertIsNone(cache.lookup([0.0, 1.0, 0.0], "news"))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_miss_on_different_news_hash(self):
+        cache = self.make_cache()
+        cache.store([1.0, 0.0, 0.0], "news", POST_A)
+        self.assertIsNone(cache.lookup([1.0, 0.0, 0.0], "other news"))
+        self.assertEqual(cache.misses, 1)
+
+    def test_expired_entries_are_pruned(self):
+        cache = self.make_cache()
+        with mock.patch("app.time.monotonic", return_value=1000.0):
+            cache.store([1.0, 0.0, 0.0], "news", POST_A)
+        with mock.patch("app.time.monotonic", return_value=1030.0):
+            cache.store([0.0, 1.0, 0.0], "news", POST_B)
+        with mock.patch("app.time.monotonic", return_value=1061.0):
+            self.assertIsNone(cache.lookup([1.0, 0.0, 0.0], "news"))
+            bucket = cache._buckets["news"]
+            self.assertEqual(bucket.values, [POST_B])
+            self.assertEqual(bucket.matrix.shape[0], 1)
+            self.assertEqual(len(cache._lru), 1)
+            self.assertEqual(cache.lookup([0.0, 1.0, 0.0], "news"), POST_B)
+        with mock.patch("app.time.monotonic", return_value=1091.0):
+            self.assertIsNone(cache.lookup([0.0, 1.0, 0.0], "news"))
+        self.assertEqual(cache._buckets, {})
+        self.assertEqual(len(cache._lru), 0)
+
+    def test_maxsize_evicts_least_recently_used_row(self):
+        cache = self.make_cache(maxsize=2)
+        cache.store([1.0, 0.0, 0.0], "news", POST_A)
+        cache.store([0.0, 1.0, 0.0], "news", POST_B)
+        # POST_A становится последним использованным, поэтому вытесняется POST_B
+        self.assertEqual(cache.lookup([1.0, 0.0, 0.0], "news"), POST_A)
+        cache.store([0.0, 0.0, 1.0], "other news", POST_C)
+
+        bucket = cache._buckets["news"]
+        self.assertEqual(bucket.values, [POST_A])
+        self.assertEqual(bucket.matrix.shape[0], 1)
+        self.assertEqual(len(bucket.keys), len(bucket.expires))
+        self.assertIsNone(cache.lookup([0.0, 1.0, 0.0], "news"))
+        self.assertEqual(cache.lookup([1.0, 0.0, 0.0], "news"), POST_A)
+        self.assertEqual(cache.lookup([0.0, 0.0, 1.0], "other news"), POST_C)
+        self.assertEqual(len(cache._lru), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()